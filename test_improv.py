@@ -4,112 +4,290 @@ Test script to send Improv WiFi protocol commands to ESP32 via Serial
 Based on Improv WiFi Serial Protocol specification
 """
 
+import logging
+import os
+import queue
+import select
 import serial
+import threading
 import time
 import struct
 
 # Improv WiFi Protocol Constants (from ImprovTypes.h)
 IMPROV_SERIAL_VERSION = 1
+IMPROV_TYPE_CURRENT_STATE = 0x01
+IMPROV_TYPE_ERROR_STATE = 0x02
 IMPROV_TYPE_RPC = 0x03  # RPC Command type
+IMPROV_TYPE_RPC_RESULT = 0x04
 IMPROV_CMD_GET_CURRENT_STATE = 0x02  # Note: 0x02, not 0x01!
 IMPROV_CMD_GET_DEVICE_INFO = 0x03
 IMPROV_CMD_GET_WIFI_NETWORKS = 0x04
 IMPROV_CMD_SET_WIFI = 0x01
+IMPROV_STATE_PROVISIONED = 0x04
+IMPROV_ERROR_NONE = 0x00
 
-def calculate_checksum(data):
-    """Calculate checksum for Improv WiFi protocol - simple sum of all bytes"""
-    checksum = 0
-    for byte in data:
-        checksum = (checksum + byte) & 0xFF
-    return checksum
+DEBUG = False  # Set True to dump raw packet/response bytes
+
+log = logging.getLogger(__name__)
+
+IMPROV_HEADER = b'IMPROV'
+IMPROV_HEADER_LENGTH = 9  # IMPROV (6) + Version (1) + Type (1) + Length (1)
+IMPROV_TYPES = {IMPROV_TYPE_CURRENT_STATE, IMPROV_TYPE_ERROR_STATE,
+                IMPROV_TYPE_RPC, IMPROV_TYPE_RPC_RESULT}
+RESPONSE_TIMEOUT = 3.0  # Seconds to wait for a response frame
+READ_CHUNK = 4096  # Max bytes per raw os.read() on the serial fd
+
+def calculate_checksum(data, initial=0):
+    """Calculate checksum for Improv WiFi protocol - simple sum of all bytes
+    Pass a previous result as initial to continue summing from it.
+    """
+    return (initial + sum(data)) & 0xFF
+
+# Checksum of the fixed IMPROV header + version + type, shared by every RPC packet
+_HEADER_CHECKSUM = calculate_checksum(IMPROV_HEADER + bytes([IMPROV_SERIAL_VERSION, IMPROV_TYPE_RPC]))
+
+# IMPROV + version + type + RPC length + command + data length, compiled once
+_RPC_HEADER = struct.Struct('<6sBBBBB')
 
 def create_improv_packet(command, data=b''):
     """Create an Improv WiFi Serial protocol packet
     Format: IMPROV (6 bytes) + Version (1) + Type (1) + Length (1) + Data (N) + Checksum (1)
     Data format: Command (1) + DataLength (1) + Data (N)
     """
-    # Build RPC data: command byte + data length byte + data bytes
-    rpc_data = bytearray([command, len(data)])
-    rpc_data.extend(data)
+    # Packet is the fixed header, the data and a checksum byte, so size it once up front
+    n = len(data)
+    packet = bytearray(_RPC_HEADER.size + n + 1)
     
-    # Build packet: IMPROV header + version + type + length + data
-    packet = bytearray([ord('I'), ord('M'), ord('P'), ord('R'), ord('O'), ord('V')])
-    packet.append(IMPROV_SERIAL_VERSION)
-    packet.append(IMPROV_TYPE_RPC)
-    packet.append(len(rpc_data))  # Length of RPC data
-    packet.extend(rpc_data)
+    _RPC_HEADER.pack_into(packet, 0, IMPROV_HEADER, IMPROV_SERIAL_VERSION, IMPROV_TYPE_RPC,
+                          n + 2, command, n)
+    packet[_RPC_HEADER.size:-1] = data
     
-    # Calculate checksum (simple sum of all bytes)
-    checksum = calculate_checksum(packet)
-    packet.append(checksum)
+    # Calculate checksum (simple sum of all bytes), starting from the cached header sum
+    packet[-1] = calculate_checksum(memoryview(packet)[8:-1], _HEADER_CHECKSUM)
     
     return bytes(packet)
 
-def send_command(ser, command, data=b''):
-    """Send an Improv WiFi command and return response"""
-    # Clear any pending serial data first
-    ser.reset_input_buffer()
-    time.sleep(0.2)  # Give device time to process
+# Packets for the payload-less commands main() sends, built once at import
+_PACKETS = {cmd: create_improv_packet(cmd) for cmd in (IMPROV_CMD_GET_CURRENT_STATE,
+                                                       IMPROV_CMD_GET_DEVICE_INFO,
+                                                       IMPROV_CMD_GET_WIFI_NETWORKS)}
+
+def _write_all(fd, data):
+    """Write all of data to the non-blocking serial fd, waiting whenever it is full
+    Raises serial.SerialException if the port fails (e.g. device unplugged).
+    """
+    view = memoryview(data)
+    try:
+        while view:
+            try:
+                view = view[os.write(fd, view):]
+            except BlockingIOError:
+                pass
+            if view:
+                select.select([], [fd], [])
+    except OSError as e:
+        raise serial.SerialException(f"write failed: {e}")
+
+class ImprovReader:
+    """Background thread that reads the serial port and queues complete Improv frames
+    Frames are located by the IMPROV header, checked for a known version and
+    type, sized by their length byte and only queued if their checksum matches;
+    any other bytes (e.g. device debug output) are discarded.
+    All input handling, including reset(), runs on the reader thread.
+    """
+    def __init__(self, ser):
+        self.ser = ser
+        self.frames = queue.SimpleQueue()  # Complete frames; None once the reader stops
+        self.error = None
+        self._resets = queue.SimpleQueue()  # Events to set once a reset has been done
+        self._stopping = threading.Event()
+        self._wake_r, self._wake_w = os.pipe()  # Wakes the reader out of select
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def check(self):
+        """Raise serial.SerialException if the reader stopped on a port error"""
+        if self.error is not None:
+            raise serial.SerialException(f"serial reader stopped: {self.error}")
+
+    def reset(self):
+        """Discard unread input, any partial frame and every queued frame
+        Returns once the reader has done it, so nothing stale is queued afterwards.
+        """
+        self.check()
+        done = threading.Event()
+        self._resets.put(done)
+        os.write(self._wake_w, b'\0')
+        # The reader may exit before taking the request, so don't wait on a dead thread
+        while not done.wait(0.1) and self._thread.is_alive():
+            pass
+        self.check()
+
+    def close(self):
+        """Stop the reader thread; call before closing the serial port"""
+        self._stopping.set()
+        os.write(self._wake_w, b'\0')
+        self._thread.join()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _run(self):
+        fd = self.ser.fileno()
+        buf = bytearray()
+        try:
+            while not self._stopping.is_set():
+                readable, _, _ = select.select([fd, self._wake_r], [], [])
+                if self._wake_r in readable:
+                    os.read(self._wake_r, 64)
+                while not self._resets.empty():
+                    self.ser.reset_input_buffer()
+                    buf.clear()
+                    while not self.frames.empty():
+                        self.frames.get_nowait()
+                    self._resets.get_nowait().set()
+                if fd not in readable:
+                    continue
+                try:
+                    chunk = os.read(fd, READ_CHUNK)
+                except (BlockingIOError, InterruptedError):
+                    continue  # Input was flushed between select and read
+                if not chunk:
+                    raise serial.SerialException("device disconnected")
+                buf.extend(chunk)
+                self._queue_frames(buf)
+        except Exception as e:  # Includes termios.error from reset_input_buffer()
+            if not self._stopping.is_set():
+                self.error = e
+        finally:
+            # Release anyone blocked on a reset or waiting for a frame
+            while not self._resets.empty():
+                self._resets.get_nowait().set()
+            self.frames.put(None)
+
+    def _queue_frames(self, buf):
+        """Move every complete frame at the front of buf onto the frame queue"""
+        while True:
+            start = buf.find(IMPROV_HEADER)
+            if start < 0:
+                # Keep a tail that could be the start of a split header
+                start = max(0, len(buf) - len(IMPROV_HEADER) + 1)
+            if start > 0:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("  Discarded %d non-Improv bytes: %r", start, bytes(buf[:start]))
+                del buf[:start]
+            if len(buf) < IMPROV_HEADER_LENGTH:
+                return
+            if buf[6] != IMPROV_SERIAL_VERSION or buf[7] not in IMPROV_TYPES:
+                # Text such as "[STATE] IMPROV_WAIT"; the length byte means nothing
+                del buf[:1]
+                continue
+            end = IMPROV_HEADER_LENGTH + buf[8] + 1
+            if len(buf) < end:
+                # A new header before the claimed end means this frame was cut short
+                if buf.find(IMPROV_HEADER, 1) > 0:
+                    del buf[:1]
+                    continue
+                return
+            if calculate_checksum(memoryview(buf)[:end - 1]) != buf[end - 1]:
+                # Not a real frame (e.g. debug text printed mid-frame); resync past this header
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("  Dropped frame with bad checksum: %s", buf[:end].hex())
+                del buf[:1]
+                continue
+            self.frames.put(bytes(buf[:end]))
+            del buf[:end]
+
+def read_improv_frames(reader, on_frame, timeout):
+    """Take frames from the reader queue, passing each to on_frame until it returns True
+    Returns the number of frames taken before finishing or timing out.
+    Raises serial.SerialException if the reader stopped on a port error.
+    """
+    count = 0
+    deadline = time.monotonic() + timeout
+    while (remaining := deadline - time.monotonic()) > 0:
+        try:
+            frame = reader.frames.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if frame is None:
+            reader.check()
+            break
+        count += 1
+        if on_frame(frame):
+            break
+    return count
+
+def _frame_command(frame):
+    """Return the command an Improv response frame answers, or None"""
+    if frame[7] == IMPROV_TYPE_CURRENT_STATE:
+        return IMPROV_CMD_GET_CURRENT_STATE
+    if frame[7] == IMPROV_TYPE_RPC_RESULT and frame[8] > 0:
+        return frame[9]
+    return None
+
+def _reply_complete(command, frame):
+    """Return True if frame is the last one of the reply to command
+    GET_WIFI_NETWORKS sends one RPC result per network and ends with an empty
+    one; GET_CURRENT_STATE in the provisioned state is followed by an RPC
+    result carrying the device URL.
+    """
+    if command == IMPROV_CMD_GET_WIFI_NETWORKS:
+        return frame[8:11] == bytes([2, command, 0])
+    if command == IMPROV_CMD_GET_CURRENT_STATE and frame[7] == IMPROV_TYPE_CURRENT_STATE:
+        return frame[8] == 0 or frame[9] != IMPROV_STATE_PROVISIONED
+    return True
+
+def send_commands(reader, commands):
+    """Send several payload-less Improv commands back-to-back and collect the responses
+    Returns a dict mapping each command to the list of frames answering it;
+    a command stays pending until its whole reply has arrived (see
+    _reply_complete). An error-state frame does not name a command, so a
+    non-zero error is recorded against the oldest command still pending.
+    """
+    reader.reset()
     
-    packet = create_improv_packet(command, data)
-    print(f"Sending command 0x{command:02x}: {packet.hex()}")
-    print(f"  Packet bytes: {[hex(b) for b in packet]}")
-    print(f"  Packet length: {len(packet)} bytes")
+    responses = {cmd: [] for cmd in commands}
+    pending = list(commands)  # In send order, so errors go to the oldest
     
-    ser.write(packet)
-    ser.flush()
-    print("  Packet sent, waiting for response...")
+    def on_frame(frame):
+        if frame[7] == IMPROV_TYPE_ERROR_STATE:
+            # Error code 0x00 means "no error" (e.g. clearing an earlier error)
+            if frame[8] > 0 and frame[9] != IMPROV_ERROR_NONE and pending:
+                command = pending.pop(0)
+                print(f"  ✗ Command 0x{command:02x} failed: error state 0x{frame[9]:02x}")
+                responses[command].append(frame)
+            return not pending
+        command = _frame_command(frame)
+        if command not in responses:
+            print(f"  Unmatched frame: {frame.hex()}")
+            return False
+        responses[command].append(frame)
+        if command in pending and _reply_complete(command, frame):
+            pending.remove(command)
+        return not pending
     
-    # Wait longer for response and check multiple times
-    response_data = bytearray()
-    for i in range(30):  # Wait up to 3 seconds
-        time.sleep(0.1)
-        if ser.in_waiting > 0:
-            chunk = ser.read(ser.in_waiting)
-            response_data.extend(chunk)
-            print(f"  Received {len(chunk)} bytes after {i*0.1:.1f}s (total: {len(response_data)} bytes)")
+    packets = b''.join(_PACKETS.get(cmd) or create_improv_packet(cmd) for cmd in commands)
+    print(f"Sending commands {', '.join(f'0x{cmd:02x}' for cmd in commands)} back-to-back")
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("  Packets: %s", packets.hex())
+    _write_all(reader.ser.fileno(), packets)
     
-    if len(response_data) > 0:
-        print(f"  Full response: {response_data.hex()}")
-        print(f"  Response bytes: {[hex(b) for b in response_data]}")
-        
-        # Try to decode as text to see if it's debug output
-        try:
-            text = response_data.decode('utf-8', errors='ignore')
-            if text.strip():
-                print(f"  Response as text: {repr(text)}")
-        except:
-            pass
-        
-        # Check for Improv WiFi response format
-        if len(response_data) >= 6 and response_data[0:6] == b'IMPROV':
-            print("  ✓ Valid Improv response header detected!")
-            return bytes(response_data)
-        elif len(response_data) >= 2 and response_data[0:2] == b'IM':
-            print("  ✓ Partial Improv response header detected!")
-            return bytes(response_data)
-        else:
-            print("  ⚠ Response doesn't start with 'IMPROV' - might be debug output or wrong format")
-            return bytes(response_data)
-    else:
-        print("  ✗ No response received after 3 seconds")
-        # Try reading one more time after a longer delay
-        time.sleep(0.5)
-        if ser.in_waiting > 0:
-            chunk = ser.read(ser.in_waiting)
-            print(f"  Late response: {chunk.hex()}")
-            return bytes(chunk)
-        return None
+    # Same total wait budget as sending the commands one at a time
+    count = read_improv_frames(reader, on_frame, RESPONSE_TIMEOUT * len(commands))
+    print(f"  Received {count} Improv frames")
+    return responses
 
 def main():
     # Serial port configuration
     port = '/dev/cu.usbmodem14101'  # Update this to your port
     baudrate = 115200
     
+    logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO, format='%(message)s')
+    
     print(f"Connecting to {port} at {baudrate} baud...")
     
     try:
-        ser = serial.Serial(port, baudrate, timeout=1)
+        ser = serial.Serial(port, baudrate)
         print("Connected! Waiting for device to be ready...")
         time.sleep(2)  # Wait for device to be ready
         
@@ -126,21 +304,27 @@ def main():
                 pass
             print()
         
+        # From here on all input goes through the background reader
+        reader = ImprovReader(ser)
+        
         print("\n=== Testing Improv WiFi Protocol ===\n")
         
+        # Pipeline all three queries; the device answers them in order
+        responses = send_commands(reader, (IMPROV_CMD_GET_CURRENT_STATE,
+                                           IMPROV_CMD_GET_DEVICE_INFO,
+                                           IMPROV_CMD_GET_WIFI_NETWORKS))
+        
         # Test 1: Get Current State
-        print("1. Testing GET_CURRENT_STATE (0x01)...")
-        response = send_command(ser, IMPROV_CMD_GET_CURRENT_STATE)
+        print("\n1. Testing GET_CURRENT_STATE (0x01)...")
+        response = b''.join(responses[IMPROV_CMD_GET_CURRENT_STATE])
         if response:
             print(f"   State response: {response.hex()}")
         else:
             print("   No response received")
         
-        time.sleep(0.5)
-        
         # Test 2: Get Device Info
         print("\n2. Testing GET_DEVICE_INFO (0x02)...")
-        response = send_command(ser, IMPROV_CMD_GET_DEVICE_INFO)
+        response = b''.join(responses[IMPROV_CMD_GET_DEVICE_INFO])
         if response:
             print(f"   Device info response: {response.hex()}")
             # Try to parse device info
@@ -149,11 +333,9 @@ def main():
         else:
             print("   No response received")
         
-        time.sleep(0.5)
-        
         # Test 3: Get WiFi Networks
         print("\n3. Testing GET_WIFI_NETWORKS (0x03)...")
-        response = send_command(ser, IMPROV_CMD_GET_WIFI_NETWORKS)
+        response = b''.join(responses[IMPROV_CMD_GET_WIFI_NETWORKS])
         if response:
             print(f"   WiFi networks response: {response.hex()}")
         else:
@@ -163,16 +345,21 @@ def main():
         print("\nIf you see valid Improv responses (starting with 'IM'),")
         print("the device is correctly implementing Improv WiFi protocol.")
         
+        reader.close()
         ser.close()
         
     except serial.SerialException as e:
-        print(f"Error opening serial port: {e}")
+        print(f"Serial port error: {e}")
+        if 'reader' in locals():
+            reader.close()
         print("\nMake sure:")
         print("1. The ESP32 is connected")
         print("2. No other program is using the serial port")
         print("3. The port name is correct")
     except KeyboardInterrupt:
         print("\n\nTest interrupted by user")
+        if 'reader' in locals():
+            reader.close()
         if 'ser' in locals():
             ser.close()
 